@@ -4,6 +4,7 @@ export interface DetectionResponse {
     classification: "AI_GENERATED" | "HUMAN";
     confidenceScore: number;
     explanation: string;
+    cacheHit?: boolean;
 }
 
 export async function detectAudio(audioBase64: string, language: string = "English"): Promise<DetectionResponse> {
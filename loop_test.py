@@ -2,16 +2,21 @@ import os
 import requests
 import numpy as np
 import soundfile as sf
-import base64
 import time
 import json
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configuration
 REAL_AUDIO_URL = "https://github.com/pdx-cs-sound/wavs/raw/main/voice.wav"
 SAMPLES_DIR = "test_samples"
 os.makedirs(SAMPLES_DIR, exist_ok=True)
-API_URL = "http://127.0.0.1:8000/api/voice-detection"
+API_URL = "http://127.0.0.1:8000/api/voice-detection/raw"
+MAX_WORKERS = 3  # concurrent requests; small enough to stay polite to the server
+
+# Shared session: keeps connections alive and pooled across test_api calls
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
 
 import requests
 import soundfile as sf
@@ -35,31 +40,36 @@ def download_file(url, filename):
         print(f"Failed to download {url}: {e}")
         return None
 
-def add_noise(audio, noise_level):
-    """Adds gaussian noise to audio."""
-    noise = np.random.normal(0, noise_level, len(audio))
-    noisy_audio = audio + noise
-    return np.clip(noisy_audio, -1.0, 1.0)
+rng = np.random.default_rng()
+
+def add_noise(audio, noise_level, out=None):
+    """Adds gaussian noise to audio, in place in `out` (a float32 buffer reused across calls) if given."""
+    if out is None:
+        out = np.empty(audio.shape, dtype=np.float32)
+    rng.standard_normal(dtype=np.float32, out=out)
+    out *= noise_level
+    out += audio
+    np.clip(out, -1.0, 1.0, out=out)
+    return out
 
 def generate_fakes(real_filepath):
     """Generates fake samples with increasing noise levels."""
     try:
-        audio, sample_rate = sf.read(real_filepath)
-        # Ensure float32
-        audio = audio.astype(np.float32)
-        if len(audio.shape) > 1:
+        audio, sample_rate = sf.read(real_filepath, dtype="float32", always_2d=False)
+        if audio.ndim > 1:
             audio = np.mean(audio, axis=1) # Mono
             
         generated_files = []
+        noisy = np.empty(audio.shape, dtype=np.float32)
         
         # Levels of "fake" (simulated by noise/artifacts)
         for level in range(1, 6):
             noise_amt = 0.005 * level # 0.5% to 2.5% noise
-            fake_audio = add_noise(audio, noise_amt)
+            fake_audio = add_noise(audio, noise_amt, out=noisy)
             
             filename = f"fake_level__{level}.wav"
             filepath = os.path.join(SAMPLES_DIR, filename)
-            sf.write(filepath, fake_audio, sample_rate)
+            sf.write(filepath, fake_audio, sample_rate, subtype="PCM_16")
             generated_files.append((filepath, level))
             print(f"Generated: {filename} (Noise: {noise_amt:.3f})")
             
@@ -69,36 +79,33 @@ def generate_fakes(real_filepath):
         print(f"Error generating fakes: {e}")
         return []
 
-def test_api(filepath):
+def read_audio_bytes(filepath):
+    with open(filepath, "rb") as f:
+        return f.read()
+
+def test_api(audio_bytes):
     try:
-        with open(filepath, "rb") as f:
-            audio_bytes = f.read()
-            base64_audio = base64.b64encode(audio_bytes).decode("utf-8")
-            
-        start = time.time()
+        start_ns = time.perf_counter_ns()
         
+        # Raw upload: no Base64 inflation or JSON encoding of the payload
         headers = {
-            "Content-Type": "application/json",
-            "x-api-key": "scamguard-secure-key-123"
+            "Content-Type": "audio/wav",
+            "x-api-key": "scamguard-secure-key-123",
+            "x-language": "English",
+            "x-audio-format": "wav"
         }
         
-        payload = {
-            "audioBase64": base64_audio,
-            "language": "English",
-            "audioFormat": "wav"
-        }
-        
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-        elapsed = (time.time() - start) * 1000
+        response = SESSION.post(API_URL, headers=headers, data=audio_bytes, timeout=30)
+        elapsed_ms = (time.perf_counter_ns() - start_ns) / 1_000_000
         
         if response.status_code == 200:
-            return response.json()
+            return response.json(), elapsed_ms
         else:
             print(f"API Error: {response.status_code} - {response.text}")
-            return None
+            return None, elapsed_ms
     except Exception as e:
         print(f"Request failed: {e}")
-        return None
+        return None, None
 
 def main():
     print("=== Deepfake Audio Detection Loop Test ===")
@@ -111,25 +118,30 @@ def main():
     # 2. Generate Fakes
     fake_files = generate_fakes(real_file)
     
-    # 3. Test Loop
+    # 3. Load every sample once up front
+    payloads = {filepath: read_audio_bytes(filepath) for filepath in [real_file] + [fp for fp, _ in fake_files]}
+    
+    # 4. Test Loop
     results = []
     
     # Test Real
     print("\n--- Testing REAL Audio ---")
-    res = test_api(real_file)
+    res, elapsed_ms = test_api(payloads[real_file])
     if res:
-        print(f"Real | Pred: {res['classification']} | Conf: {res['confidenceScore']:.2%} | Time: {elapsed if 'elapsed' in locals() else 'N/A'}ms")
+        print(f"Real | Pred: {res['classification']} | Conf: {res['confidenceScore']:.2%} | Time: {elapsed_ms:.1f}ms")
         print(f"Reason: {res['explanation']}")
         results.append({"type": "real", "level": 0, "result": res})
         
     # Test Fakes
     print("\n--- Testing FAKE (Simulated) Audio Loop ---")
-    for filepath, level in fake_files:
-        res = test_api(filepath)
-        if res:
-            print(f"Fake L{level} | Pred: {res['classification']} | Conf: {res['confidenceScore']:.2%}")
-            results.append({"type": "fake", "level": level, "result": res})
-        time.sleep(1) # Be nice to the server
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(test_api, payloads[filepath]): level for filepath, level in fake_files}
+        for future in as_completed(futures):
+            level = futures[future]
+            res, elapsed_ms = future.result()
+            if res:
+                print(f"Fake L{level} | Pred: {res['classification']} | Conf: {res['confidenceScore']:.2%} | Time: {elapsed_ms:.1f}ms")
+                results.append({"type": "fake", "level": level, "result": res})
         
     # Summary
     print("\n=== Test Summary ===")
@@ -5,22 +5,30 @@ A FastAPI-based REST API for detecting AI-generated/deepfake audio.
 Compliant with strict security and validation standards.
 """
 
-import base64
+import asyncio
+import binascii
+import concurrent.futures
+import hashlib
 import io
+import math
 import time
 import logging
 import os
 import secrets
+import threading
 from typing import Optional, Literal
 from contextlib import asynccontextmanager
 
 import torch
 import soundfile as sf
 import numpy as np
+from scipy.signal import resample_poly
 from fastapi import FastAPI, HTTPException, Header, Request, Depends
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, validator
+from async_batcher.batcher import AsyncBatcher
+from cachetools import LRUCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -36,16 +44,245 @@ API_KEY = os.environ.get("SCAMGUARD_API_KEY", "scamguard-secure-key-123")  # In
 # Allowed Languages
 ALLOWED_LANGUAGES = {"Tamil", "English", "Hindi", "Malayalam", "Telugu"}
 
+# Model labels containing any of these map to AI_GENERATED
+FAKE_LABEL_KEYWORDS = ("fake", "spoof", "synthetic", "ai")
+
+# Exported ONNX graph, reused across restarts; the actual file names are keyed on
+# the model and its inputs (see onnx_model_paths)
+ONNX_MODEL_PATH = os.environ.get("SCAMGUARD_ONNX_PATH", "model.onnx")
+QUANTIZE_MODEL = os.environ.get("SCAMGUARD_QUANTIZE", "1") == "1"  # INT8 dynamic quantization of Linear/MatMul weights
+# Execution providers in order of preference; OpenVINO is used when onnxruntime-openvino is installed
+ORT_PROVIDERS = ("OpenVINOExecutionProvider", "CPUExecutionProvider")
+
+# Micro-batching: concurrent requests are coalesced into one forward pass
+MAX_BATCH_SIZE = 8
+MAX_QUEUE_TIME = 0.05  # seconds a request may wait for the batch to fill
+
+# Results for recently seen audio, keyed by a hash of the decoded bytes
+PREDICTION_CACHE_SIZE = 1024
+
+# Masked inputs are zero-padded up to one of these lengths so compiled graphs are reused.
+# Models without an attention mask mean-pool over every frame, padding included, so
+# their inputs are never padded: only clips of equal length are batched together
+LENGTH_BUCKETS = tuple(seconds * TARGET_SAMPLE_RATE for seconds in (1, 2, 4, 8, 16, 30))
+WARMUP_RUNS = 2  # per warm-up shape, at startup
+
 # Global model pointers
 feature_extractor = None
 model = None
+ort_session = None
+batcher = None
+fast_features = False  # numpy preprocessing, enabled when the extractor config allows it
+use_attention_mask = False  # whether the model expects a mask over padded samples
+fake_label_ids = set()  # class ids whose label marks synthetic speech, resolved at load time
+INFER_POOL = None  # single worker: torch/ORT already parallelize each forward pass internally
+
+prediction_cache = LRUCache(maxsize=PREDICTION_CACHE_SIZE)
+prediction_cache_lock = threading.Lock()
+
+# ===========================
+# ONNX Runtime Backend
+# ===========================
+class LogitsOnly(torch.nn.Module):
+    """Wraps the HF classifier so the exported graph has a single `logits` output."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_values, attention_mask=None):
+        return self.model(input_values=input_values, attention_mask=attention_mask).logits
+
+def onnx_model_paths(with_attention_mask: bool) -> tuple[str, str]:
+    """Returns the fp32 and INT8 graph paths for MODEL_NAME, so an export of another model or input signature is never reused."""
+    stem = ONNX_MODEL_PATH.rsplit(".", 1)[0]
+    tag = MODEL_NAME.replace("/", "--") + (".mask" if with_attention_mask else "")
+    return f"{stem}.{tag}.onnx", f"{stem}.{tag}.int8.onnx"
+
+def export_onnx(model, path: str, with_attention_mask: bool = False):
+    dummy_input_values = torch.zeros(1, TARGET_SAMPLE_RATE, dtype=torch.float32)
+    args = (dummy_input_values,)
+    input_names = ["input_values"]
+    dynamic_axes = {"input_values": {0: "b", 1: "t"}, "logits": {0: "b"}}
+    if with_attention_mask:
+        args += (torch.ones(1, TARGET_SAMPLE_RATE, dtype=torch.int64),)
+        input_names.append("attention_mask")
+        dynamic_axes["attention_mask"] = {0: "b", 1: "t"}
+    tmp_path = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            LogitsOnly(model),
+            args,
+            tmp_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False,  # TorchScript exporter: no onnxscript dependency, and its graph quantizes cleanly
+        )
+    # Only a complete graph is ever visible at `path`
+    os.replace(tmp_path, path)
+
+def quantize_onnx(path: str, output_path: str):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    tmp_path = output_path + ".tmp"
+    quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, output_path)
+
+def load_onnx_session(path: str):
+    import onnxruntime as ort
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.intra_op_num_threads = os.cpu_count() or 1
+    available = ort.get_available_providers()
+    providers = [p for p in ORT_PROVIDERS if p in available]
+    return ort.InferenceSession(path, sess_options=so, providers=providers)
+
+def run_model(input_values: np.ndarray, attention_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """Returns logits for a (batch, samples) float32 array, via ONNX Runtime when available."""
+    if ort_session is not None:
+        feeds = {"input_values": input_values}
+        if attention_mask is not None:
+            feeds["attention_mask"] = attention_mask
+        return ort_session.run(["logits"], feeds)[0]
+    mask = None if attention_mask is None else torch.from_numpy(attention_mask)
+    with torch.inference_mode():
+        return model(input_values=torch.from_numpy(input_values), attention_mask=mask).logits.numpy()
+
+def bucket_length(length: int) -> int:
+    for bucket in LENGTH_BUCKETS:
+        if bucket >= length:
+            return bucket
+    # Longer clips round up to a multiple of the largest bucket
+    return -(-length // LENGTH_BUCKETS[-1]) * LENGTH_BUCKETS[-1]
+
+def pad_to_bucket(input_values: np.ndarray, attention_mask: np.ndarray):
+    length = input_values.shape[-1]
+    pad = bucket_length(length) - length
+    if pad == 0:
+        return input_values, attention_mask
+    input_values = np.pad(input_values, ((0, 0), (0, pad)), constant_values=feature_extractor.padding_value)
+    attention_mask = np.pad(attention_mask, ((0, 0), (0, pad)))
+    return input_values, attention_mask
+
+def extract_features(audios: list[np.ndarray]) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """Builds the (batch, samples) model input, plus its attention mask if the model uses one.
+
+    Masked inputs are padded up to a length bucket; unmasked ones only to the longest clip,
+    which predict_batch keeps equal to every clip's length.
+    """
+    if not fast_features:
+        inputs = feature_extractor(
+            audios,
+            sampling_rate=TARGET_SAMPLE_RATE,
+            return_tensors="np",
+            padding=True,
+            return_attention_mask=use_attention_mask,
+        )
+        input_values = inputs["input_values"].astype(np.float32, copy=False)
+        if not use_attention_mask:
+            return input_values, None
+        return pad_to_bucket(input_values, inputs["attention_mask"].astype(np.int64))
+
+    # Same zero-mean/unit-variance normalization as Wav2Vec2FeatureExtractor, written
+    # straight into the batch buffer
+    length = max(len(audio) for audio in audios)
+    input_values = np.full((len(audios), length), feature_extractor.padding_value, dtype=np.float32)
+    for row, audio in zip(input_values, audios):
+        values = row[:len(audio)]
+        if feature_extractor.do_normalize:
+            np.subtract(audio, audio.mean(), out=values)
+            values /= np.sqrt(audio.var() + 1e-7)
+        else:
+            values[:] = audio
+    return input_values, None
+
+def supports_fast_features(extractor) -> bool:
+    # Raw-waveform extractor without attention masks: preprocessing is just normalization
+    return (
+        type(extractor).__name__ == "Wav2Vec2FeatureExtractor"
+        and extractor.feature_size == 1
+        and not extractor.return_attention_mask
+    )
+
+# ===========================
+# Micro-batching
+# ===========================
+def predict_batch(audios: list[np.ndarray]) -> list[tuple[int, float]]:
+    """Runs 16 kHz clips through the model, returning (pred_id, confidence) per clip."""
+    if use_attention_mask:
+        logits = run_model(*extract_features(audios))
+    else:
+        # No mask means padding would be pooled into the prediction, so each forward
+        # pass only takes clips of the same length
+        groups = {}
+        for index, audio in enumerate(audios):
+            groups.setdefault(len(audio), []).append(index)
+        rows = [None] * len(audios)
+        for indices in groups.values():
+            group_logits = run_model(*extract_features([audios[index] for index in indices]))
+            for index, row in zip(indices, group_logits):
+                rows[index] = row
+        logits = np.stack(rows)
+    logits = torch.from_numpy(logits)
+    with torch.inference_mode():
+        probs = torch.nn.functional.softmax(logits, dim=-1)
+        confidences, pred_ids = probs.max(dim=-1)
+    return list(zip(pred_ids.tolist(), confidences.tolist()))
+
+def warmup_model():
+    """Runs the full predict path for each padded input length, and at full batch size, so one-time graph setup is paid before the first request."""
+    # Only masked inputs are padded to the buckets; unmasked clips keep their own length,
+    # so one representative length covers them
+    lengths = LENGTH_BUCKETS if use_attention_mask else LENGTH_BUCKETS[:1]
+    for length in lengths:
+        dummy = np.zeros(length, dtype=np.float32)
+        for _ in range(WARMUP_RUNS):
+            predict_batch([dummy])
+    # Batches of 2..MAX_BATCH_SIZE share one dynamic-shape graph, separate from the batch-of-1 one
+    dummy = np.zeros(lengths[0], dtype=np.float32)
+    for _ in range(WARMUP_RUNS):
+        predict_batch([dummy] * MAX_BATCH_SIZE)
+
+def check_parity() -> float:
+    """Returns the largest confidence difference between one predict_batch call over mixed-length
+    clips and the baseline path of one unpadded clip at a time through the feature extractor.
+
+    For tests against a loaded model; not run at startup.
+    """
+    rng = np.random.default_rng(0)
+    audios = [
+        0.1 * rng.standard_normal(int(seconds * TARGET_SAMPLE_RATE), dtype=np.float32)
+        for seconds in (0.7, 2.1, 3.4)
+    ]
+    drift = 0.0
+    for audio, (pred_id, confidence) in zip(audios, predict_batch(audios)):
+        inputs = feature_extractor(
+            audio,
+            sampling_rate=TARGET_SAMPLE_RATE,
+            return_tensors="np",
+            return_attention_mask=use_attention_mask,
+        )
+        attention_mask = inputs["attention_mask"].astype(np.int64) if use_attention_mask else None
+        logits = torch.from_numpy(run_model(inputs["input_values"].astype(np.float32, copy=False), attention_mask))
+        with torch.inference_mode():
+            probs = torch.nn.functional.softmax(logits, dim=-1)[0]
+        drift = max(drift, abs(probs[pred_id].item() - confidence))
+    return drift
+
+class AudioBatcher(AsyncBatcher):
+    """Queues 16 kHz clips and classifies them in batches of up to `max_batch_size`."""
+
+    async def process_batch(self, batch: list[np.ndarray]) -> list[tuple[int, float]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(INFER_POOL, predict_batch, batch)
 
 # ===========================
 # Application Lifespan
 # ===========================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global feature_extractor, model
+    global feature_extractor, model, ort_session, batcher, fast_features, use_attention_mask, fake_label_ids, INFER_POOL
     logger.info(f"Loading model: {MODEL_NAME}")
     try:
         from transformers import AutoFeatureExtractor, AutoModelForAudioClassification
@@ -57,11 +294,60 @@ async def lifespan(app: FastAPI):
             feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
             model = AutoModelForAudioClassification.from_pretrained(MODEL_NAME)
         model.eval()
-        logger.info("Model loaded successfully!")
+        fast_features = supports_fast_features(feature_extractor)
+        use_attention_mask = bool(feature_extractor.return_attention_mask)
+        fake_label_ids = {
+            label_id for label_id, label in model.config.id2label.items()
+            if any(keyword in label.lower() for keyword in FAKE_LABEL_KEYWORDS)
+        }
+        logger.info(f"Model loaded successfully! (numpy preprocessing: {fast_features})")
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
+
+    if model is not None:
+        try:
+            onnx_path, int8_path = onnx_model_paths(use_attention_mask)
+            if not os.path.exists(onnx_path):
+                logger.info(f"Exporting model to ONNX: {onnx_path}")
+                export_onnx(model, onnx_path, with_attention_mask=use_attention_mask)
+            session_path = onnx_path
+            if QUANTIZE_MODEL:
+                # A failed quantization still leaves the fp32 graph to serve from ORT
+                try:
+                    # Re-quantize whenever the fp32 graph was re-exported after the INT8 one
+                    if not os.path.exists(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(onnx_path):
+                        logger.info(f"Quantizing ONNX model to INT8: {int8_path}")
+                        quantize_onnx(onnx_path, int8_path)
+                    session_path = int8_path
+                except Exception as e:
+                    logger.warning(f"INT8 quantization failed, serving the fp32 ONNX graph: {e}")
+            ort_session = load_onnx_session(session_path)
+            logger.info(f"ONNX Runtime session ready! ({session_path}, {ort_session.get_providers()[0]})")
+        except Exception as e:
+            logger.warning(f"ONNX Runtime unavailable, using PyTorch: {e}")
+            if QUANTIZE_MODEL:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if model is not None:
+        torch.set_num_threads(os.cpu_count() or 1)
+        if ort_session is None:
+            # Batch size and length vary per request, so compile with dynamic shapes rather than
+            # recompiling for each one; "reduce-overhead" (CUDA graphs) does nothing on CPU
+            model = torch.compile(model, dynamic=True)
+        try:
+            warmup_model()
+            logger.info("Model warmed up")
+        except Exception as e:
+            logger.warning(f"Warm-up failed, serving uncompiled model: {e}")
+            model = getattr(model, "_orig_mod", model)
+        INFER_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        batcher = AudioBatcher(max_batch_size=MAX_BATCH_SIZE, max_queue_time=MAX_QUEUE_TIME)
     yield
     logger.info("Application shutting down...")
+    if batcher is not None:
+        await batcher.stop()
+    if INFER_POOL is not None:
+        INFER_POOL.shutdown(wait=True)
 
 # ===========================
 # FastAPI App Initialization
@@ -116,27 +402,61 @@ class VoiceDetectionResponse(BaseModel):
     classification: Literal["AI_GENERATED", "HUMAN"]
     confidenceScore: float
     explanation: str
+    cacheHit: bool = False
 
 # ===========================
 # Helper Functions
 # ===========================
-def decode_and_validate_audio(base64_str: str) -> tuple[np.ndarray, int]:
+def _to_mono(audio: np.ndarray) -> np.ndarray:
+    """Averages channels into a single float32 buffer."""
+    # Accumulate channels in place (np.mean would allocate a sum, then divide it)
+    mono = np.array(audio[:, 0], dtype=np.float32)
+    for channel in range(1, audio.shape[1]):
+        mono += audio[:, channel]
+    mono *= 1.0 / audio.shape[1]
+    return mono
+
+def decode_base64_audio(base64_str: str) -> bytes:
     try:
-        audio_bytes = base64.b64decode(base64_str)
-        if len(audio_bytes) == 0:
-            raise ValueError("Empty audio payload")
-        
-        # soundfile can auto-detect format (mp3/wav) from bytes
+        # a2b_base64 reads the ASCII str buffer in place; base64.b64decode would
+        # first copy the whole payload via str.encode("ascii")
+        audio_bytes = binascii.a2b_base64(base64_str)
+    except Exception as e:
+        raise ValueError(f"Invalid audio data: {str(e)}")
+    if len(audio_bytes) == 0:
+        raise ValueError("Invalid audio data: Empty audio payload")
+    return audio_bytes
+
+def decode_and_validate_audio(audio_bytes: bytes) -> tuple[np.ndarray, int]:
+    try:
+        # soundfile can auto-detect format (mp3/wav) from bytes; BytesIO shares
+        # the bytes buffer until written to, so this does not copy the payload
         audio_buffer = io.BytesIO(audio_bytes)
-        audio_array, sample_rate = sf.read(audio_buffer)
+        audio_array, sample_rate = sf.read(audio_buffer, dtype="float32", always_2d=False)
         
-        if len(audio_array.shape) > 1:
-            audio_array = np.mean(audio_array, axis=1) # Mono
+        if audio_array.ndim > 1:
+            audio_array = _to_mono(audio_array)
         
-        return audio_array.astype(np.float32), sample_rate
+        return audio_array, sample_rate
     except Exception as e:
         raise ValueError(f"Invalid audio data: {str(e)}")
 
+def audio_cache_key(audio_bytes: bytes) -> bytes:
+    return hashlib.blake2b(audio_bytes, digest_size=16).digest()
+
+def get_cached_prediction(key: bytes) -> Optional[tuple[str, float]]:
+    with prediction_cache_lock:
+        return prediction_cache.get(key)
+
+def cache_prediction(key: bytes, classification: str, confidence: float):
+    with prediction_cache_lock:
+        prediction_cache[key] = (classification, confidence)
+
+def _resample(audio: np.ndarray, orig: int, tgt: int) -> np.ndarray:
+    # Polyphase FIR resampling: anti-aliased, single pass over the signal
+    g = math.gcd(orig, tgt)
+    return resample_poly(audio, tgt // g, orig // g).astype(np.float32, copy=False)
+
 def generate_explanation(classification: str, confidence: float, language: str) -> str:
     conf_percent = int(confidence * 100)
     if classification == "AI_GENERATED":
@@ -147,58 +467,90 @@ def generate_explanation(classification: str, confidence: float, language: str)
 # ===========================
 # Endpoints
 # ===========================
-@app.post("/api/voice-detection", response_model=VoiceDetectionResponse, dependencies=[Depends(verify_api_key)])
-def detect_voice(request: VoiceDetectionRequest):
-    # 1. Validate Audio
+def load_audio(audio_bytes: bytes) -> np.ndarray:
+    """Decodes, validates and resamples audio bytes to 16 kHz mono (blocking). Raises HTTPException on bad input."""
+    # Validate Audio
     try:
-        audio_array, sample_rate = decode_and_validate_audio(request.audioBase64)
+        audio_array, sample_rate = decode_and_validate_audio(audio_bytes)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-    # 2. Duration Check
+    # Duration Check
     duration = len(audio_array) / sample_rate
     if duration < 0.1 or duration > 300:
         raise HTTPException(status_code=400, detail="Audio duration must be between 0.1s and 300s")
 
-    # 3. Model Inference (Sync to prevent blocking)
-    if model is None or feature_extractor is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
     # Resample
     if sample_rate != TARGET_SAMPLE_RATE:
-        # Simple resampling using scipy or numpy interp
-        num_samples = int(len(audio_array) * TARGET_SAMPLE_RATE / sample_rate)
-        audio_array = np.interp(
-            np.linspace(0.0, 1.0, num_samples, endpoint=False),
-            np.linspace(0.0, 1.0, len(audio_array), endpoint=False),
-            audio_array
-        )
+        audio_array = _resample(audio_array, sample_rate, TARGET_SAMPLE_RATE)
+    return audio_array
+
+async def classify_audio(audio_bytes: bytes) -> tuple[str, float]:
+    """Validates decoded audio bytes and runs them through the model. Raises HTTPException on bad input."""
+    # Decoding and resampling run in a worker thread so they never stall the event loop
+    audio_array = await asyncio.to_thread(load_audio, audio_bytes)
+
+    # Model Inference (batched across concurrent requests)
+    if model is None or feature_extractor is None or batcher is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
 
     # Predict
-    with torch.no_grad():
-        inputs = feature_extractor(audio_array, sampling_rate=TARGET_SAMPLE_RATE, return_tensors="pt", padding=True)
-        logits = model(**inputs).logits
-        probs = torch.nn.functional.softmax(logits, dim=-1)
-        pred_id = torch.argmax(probs, dim=-1).item()
-        confidence = probs[0][pred_id].item()
+    pred_id, confidence = await batcher.process(audio_array)
 
-    raw_label = model.config.id2label.get(pred_id, "unknown").lower()
-    
     # Map to Strict Output Classes
-    is_fake = any(x in raw_label for x in ["fake", "spoof", "synthetic", "ai"])
-    classification = "AI_GENERATED" if is_fake else "HUMAN"
+    classification = "AI_GENERATED" if pred_id in fake_label_ids else "HUMAN"
+    return classification, confidence
+
+async def detect_audio_bytes(audio_bytes: bytes, language: str) -> VoiceDetectionResponse:
+    # Cache Lookup (skips audio decoding and inference for repeated audio)
+    cache_key = await asyncio.to_thread(audio_cache_key, audio_bytes)
+    cached = get_cached_prediction(cache_key)
+    if cached is not None:
+        classification, confidence = cached
+    else:
+        # Validation & Model Inference
+        classification, confidence = await classify_audio(audio_bytes)
+        cache_prediction(cache_key, classification, confidence)
     
-    # 4. Explanation
-    explanation = generate_explanation(classification, confidence, request.language)
+    # Explanation
+    explanation = generate_explanation(classification, confidence, language)
 
     return VoiceDetectionResponse(
         status="success",
-        language=request.language,
+        language=language,
         classification=classification,
         confidenceScore=round(confidence, 4),
-        explanation=explanation
+        explanation=explanation,
+        cacheHit=cached is not None
     )
 
+@app.post("/api/voice-detection", response_model=VoiceDetectionResponse, dependencies=[Depends(verify_api_key)])
+async def detect_voice(request: VoiceDetectionRequest):
+    try:
+        audio_bytes = await asyncio.to_thread(decode_base64_audio, request.audioBase64)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return await detect_audio_bytes(audio_bytes, request.language)
+
+@app.post("/api/voice-detection/raw", response_model=VoiceDetectionResponse, dependencies=[Depends(verify_api_key)])
+async def detect_voice_raw(
+    request: Request,
+    x_language: str = Header(..., description="Language of the audio (Tamil, English, Hindi, Malayalam, Telugu)"),
+    x_audio_format: str = Header(..., description="Format of the audio (mp3, wav)"),
+):
+    """Same as /api/voice-detection, but the body is the raw audio file rather than Base64 JSON."""
+    if x_language not in ALLOWED_LANGUAGES:
+        raise HTTPException(status_code=422, detail=f"Language must be one of {ALLOWED_LANGUAGES}")
+    if x_audio_format.lower() not in ["mp3", "wav"]:
+        raise HTTPException(status_code=422, detail="audioFormat must be 'mp3' or 'wav'")
+
+    audio_bytes = await request.body()
+    if len(audio_bytes) == 0:
+        raise HTTPException(status_code=400, detail="Invalid audio data: Empty audio payload")
+
+    return await detect_audio_bytes(audio_bytes, x_language)
+
 # ===========================
 # Error Handling
 # ===========================
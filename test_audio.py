@@ -7,47 +7,151 @@ This script provides utilities to:
 3. Generate sample test audio
 """
 
-import base64
-import json
+import binascii
+import functools
+import glob
+import hashlib
+import itertools
+import math
+import mmap
+import struct
 import sys
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def audio_to_base64(file_path: str) -> str:
+# Bind the codec functions once at import so hot loops skip the module attribute lookup
+try:
+    from pybase64 import b64encode as _b64e, b64decode as _b64d  # SIMD-accelerated, stdlib-compatible API
+except ImportError:
+    from base64 import b64encode as _b64e, b64decode as _b64d
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
+
+
+# Heavy dependencies are imported on first use only, and the module handle is
+# kept so --batch runs don't repeat the import machinery per file
+@functools.lru_cache(maxsize=1)
+def _np():
+    import numpy
+    return numpy
+
+
+@functools.lru_cache(maxsize=1)
+def _requests():
+    import requests
+    return requests
+
+# Read size for streaming Base64 encoding; a multiple of 3 so chunks encode without padding
+ENCODE_CHUNK_SIZE = 3 * 65536
+
+# --convert prints payloads shorter than this in full, otherwise just a preview
+MAX_PRINTED_BASE64 = 4096
+
+# Responses for previously tested files, keyed by endpoint and SHA-256 of the file
+DETECT_CACHE_PATH = ".karylok_detect_cache.json"
+
+# Format the API's model consumes; WAV uploads are converted to this before encoding
+MODEL_SAMPLE_RATE = 16000
+
+def audio_to_base64(file_path: str, normalize: bool = True) -> bytes | bytearray:
     """
-    Convert an audio file to Base64 string.
+    Convert an audio file to Base64 bytes.
     
     Args:
         file_path: Path to the audio file (WAV format recommended)
+        normalize: Re-encode WAV input as 16 kHz mono 16-bit PCM first,
+            shrinking the payload to what the model actually uses
         
     Returns:
-        Base64 encoded string
+        Base64 encoded ASCII bytes
     """
-    with open(file_path, "rb") as audio_file:
-        audio_bytes = audio_file.read()
-        base64_string = base64.b64encode(audio_bytes).decode("utf-8")
-    return base64_string
+    if normalize and file_path.lower().endswith(".wav"):
+        wav_bytes = _normalize_wav(file_path)
+        if wav_bytes is not None:
+            return _b64e(wav_bytes)
+
+    size = os.path.getsize(file_path)
+    out = bytearray(4 * -(-size // 3))
+    if size == 0:
+        return out
+    # Encode straight from the page cache via mmap, chunk by chunk, into a
+    # buffer preallocated to the exact Base64 length
+    with open(file_path, "rb") as audio_file, \
+            mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped) as view:
+        pos = 0
+        for start in range(0, size, ENCODE_CHUNK_SIZE):
+            encoded = _b64e(view[start:start + ENCODE_CHUNK_SIZE])
+            out[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+    return out
 
 
-def base64_to_audio(base64_string: str, output_path: str):
+def base64_to_audio(base64_string: bytes | str, output_path: str):
     """
     Convert Base64 string back to audio file.
     
     Args:
-        base64_string: Base64 encoded audio
+        base64_string: Base64 encoded audio (bytes or str)
         output_path: Path to save the audio file
+        
+    Raises:
+        binascii.Error: If the input contains non-Base64 characters
     """
-    audio_bytes = base64.b64decode(base64_string)
+    if isinstance(base64_string, str):
+        try:
+            base64_string = base64_string.encode("ascii")
+        except UnicodeEncodeError as e:
+            raise binascii.Error(f"Non-Base64 character in input: {e}") from e
+    # Drop line breaks/spaces in one translate pass so the decoder can run
+    # its strict (vectorized) validation instead of skipping them per byte
+    base64_string = base64_string.translate(None, b" \t\r\n")
+    audio_bytes = _b64d(base64_string, validate=True)
     with open(output_path, "wb") as audio_file:
         audio_file.write(audio_bytes)
     print(f"Audio saved to: {output_path}")
 
 
-def test_api(audio_base64: str, api_url: str = "http://127.0.0.1:8000/detect", timeout: int = 60):
+_SESSION = None
+
+
+def _get_session():
+    """Return a shared requests.Session so repeated calls reuse pooled keep-alive connections."""
+    global _SESSION
+    if _SESSION is None:
+        requests = _requests()
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _SESSION = session
+    return _SESSION
+
+
+def _print_result(result: dict):
+    print(f"   Prediction: {result['prediction']}")
+    print(f"   Confidence: {result['confidence']:.2%}")
+    print(f"   Inference Time: {result['inference_time_ms']:.2f} ms")
+    print(f"   Model: {result['model_name']}")
+
+
+def test_api(audio_base64: bytes | str, api_url: str = "http://127.0.0.1:8000/detect", timeout: int = 60):
     """
     Test the detection API with Base64 audio.
     
     Args:
-        audio_base64: Base64 encoded audio
+        audio_base64: Base64 encoded audio (bytes or str)
         api_url: API endpoint URL
         timeout: Request timeout in seconds
         
@@ -55,26 +159,30 @@ def test_api(audio_base64: str, api_url: str = "http://127.0.0.1:8000/detect", t
         dict: API response or None if failed
     """
     try:
-        import requests
+        requests = _requests()
     except ImportError:
         print("Please install requests: pip install requests")
         return None
     
-    payload = {"audio_base64": audio_base64}
+    if isinstance(audio_base64, str):
+        # Caller-supplied text (e.g. read back from a _base64.txt file) may carry
+        # newlines that need escaping, so serialize it properly
+        body = _dumps({"audio_base64": audio_base64})
+    else:
+        # Our own encoder output never needs JSON escaping, so the body is
+        # assembled directly instead of serializing a multi-MB string
+        body = b'{"audio_base64":"' + audio_base64 + b'"}'
     
     print(f"\nSending request to: {api_url}")
     print(f"Audio Base64 length: {len(audio_base64)} characters")
     
     try:
-        response = requests.post(api_url, json=payload, timeout=timeout)
+        response = _get_session().post(api_url, data=body, timeout=timeout)
         
         if response.status_code == 200:
-            result = response.json()
+            result = _loads(response.content)
             print("\n✅ API Response:")
-            print(f"   Prediction: {result['prediction']}")
-            print(f"   Confidence: {result['confidence']:.2%}")
-            print(f"   Inference Time: {result['inference_time_ms']:.2f} ms")
-            print(f"   Model: {result['model_name']}")
+            _print_result(result)
             return result
         else:
             print(f"\n❌ Error: {response.status_code}")
@@ -90,36 +198,306 @@ def test_api(audio_base64: str, api_url: str = "http://127.0.0.1:8000/detect", t
         return None
 
 
-def generate_test_tone(output_path: str = "test_tone.wav", duration: float = 2.0, frequency: float = 440.0) -> str | None:
+def _file_sha256(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        while chunk := f.read(ENCODE_CHUNK_SIZE):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def _load_detect_cache() -> dict:
+    try:
+        with open(DETECT_CACHE_PATH, "rb") as f:
+            return _loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_detect_cache(cache: dict):
+    with open(DETECT_CACHE_PATH, "wb") as f:
+        f.write(_dumps(cache))
+
+
+def detect_file(file_path: str, api_url: str = "http://127.0.0.1:8000/detect", use_cache: bool = True):
     """
-    Generate a simple test tone audio file.
+    Test the detection API with an audio file.
+    
+    The file is hashed before anything else; if this exact file was already
+    sent to the same endpoint, the stored response is returned without
+    encoding or sending it again.
     
     Args:
-        output_path: Path to save the test audio
-        duration: Duration in seconds (0.1 to 300)
-        frequency: Frequency of the tone in Hz
+        file_path: Path to the audio file
+        api_url: API endpoint URL
+        use_cache: Reuse a stored response. When False the file is always
+            sent, and the stored response is replaced with the new one
         
     Returns:
-        str: Path to the generated file, or None if failed
+        dict: API response or None if failed
+    """
+    key = f"{api_url} {_file_sha256(file_path)}"
+    cache = _load_detect_cache()
+    if use_cache and key in cache:
+        print(f"\n✅ Cached API Response ({DETECT_CACHE_PATH}, --no-cache to resend):")
+        _print_result(cache[key])
+        return cache[key]
+    
+    base64_audio = audio_to_base64(file_path)
+    print(f"Base64 length: {len(base64_audio)} characters")
+    result = test_api(base64_audio, api_url)
+    if result is not None:
+        cache[key] = result
+        _save_detect_cache(cache)
+    return result
+
+
+def detect_batch(directory: str) -> dict:
+    """
+    Test every WAV file in a directory.
+    
+    Files are Base64-encoded in parallel on a thread pool (the encoder runs in
+    C and releases the GIL) and sent to the API in order. Encoding runs at most
+    one pool's worth of files ahead of the requests, so only that many
+    payloads are held in memory at once.
+    
+    Args:
+        directory: Directory containing .wav files
+        
+    Returns:
+        dict: File path -> API response (None if that file failed)
+    """
+    files = sorted(glob.glob(os.path.join(directory, "*.wav")))
+    if not files:
+        print(f"No .wav files found in: {directory}")
+        return {}
+    
+    results = {}
+    max_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        queued = iter(files)
+        pending = deque((path, executor.submit(audio_to_base64, path)) for path in itertools.islice(queued, max_workers))
+        while pending:
+            path, future = pending.popleft()
+            # Refill the window as each payload is taken for sending
+            next_path = next(queued, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(audio_to_base64, next_path)))
+            print(f"\n=== {path} ===")
+            try:
+                audio_base64 = future.result()
+            except Exception as e:
+                # One unreadable file must not abort the rest of the batch
+                print(f"Failed to encode {path}: {e}")
+                results[path] = None
+                continue
+            results[path] = test_api(audio_base64)
+    
+    passed = sum(result is not None for result in results.values())
+    print(f"\nBatch complete: {passed}/{len(files)} files returned a result")
+    return results
+
+
+def _fill_sine(out, step, amplitude):
+    """
+    Fill `out` with amplitude * sin(n * step) using the oscillator recurrence
+    s[n+1] = 2*cos(step)*s[n] - s[n-1] (two multiplies and an add per sample).
+    """
+    coeff = 2.0 * math.cos(step)
+    prev = -amplitude * math.sin(step)
+    cur = 0.0
+    for n in range(out.shape[0]):
+        out[n] = cur
+        prev, cur = cur, coeff * cur - prev
+
+
+def _pcm16_wav_header(data_len: int, sample_rate: int) -> bytes:
+    """44-byte RIFF header: RIFF chunk, 16-byte PCM fmt chunk (mono, 16-bit), data chunk."""
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_len, b"WAVE",
+        b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b"data", data_len,
+    )
+
+
+def _pcm16_wav(samples, sample_rate: int) -> bytearray:
+    """Build a mono 16-bit PCM WAV file from float samples in [-1, 1], in a single buffer."""
+    np = _np()
+    data_len = 2 * len(samples)
+    wav = bytearray(44 + data_len)
+    wav[:44] = _pcm16_wav_header(data_len, sample_rate)
+    # Quantize straight into the buffer's data section: no tobytes() copy and
+    # no header + data concatenation
+    scaled = np.clip(samples, -1.0, 1.0)
+    scaled *= 32767
+    np.rint(scaled, out=np.frombuffer(wav, dtype="<i2", offset=44), casting="unsafe")
+    return wav
+
+
+def _write_wav_pcm16(path: str, samples, sample_rate: int):
+    """
+    Write mono float samples in [-1, 1] as a 16-bit PCM WAV file.
+    
+    Args:
+        path: Output file path
+        samples: float32 numpy array of samples
+        sample_rate: Sample rate in Hz
+    """
+    with open(path, "wb") as wav_file:
+        wav_file.write(_pcm16_wav(samples, sample_rate))
+
+
+# (format tag, bits per sample) -> numpy dtype for the WAV encodings _normalize_wav reads
+_WAV_DTYPES = {(1, 16): "<i2", (1, 32): "<i4", (3, 32): "<f4", (3, 64): "<f8"}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _normalize_wav(path: str) -> bytearray | None:
+    """
+    Re-encode a WAV file as 16 kHz mono 16-bit PCM.
+    
+    Args:
+        path: Path to the WAV file
+        
+    Returns:
+        bytes: The new WAV file, or None if the input is already in that
+        format, is truncated or malformed, or uses an encoding this parser
+        does not handle
     """
     try:
-        import numpy as np
-        import soundfile as sf
+        np = _np()
     except ImportError:
-        print("Please install numpy and soundfile: pip install numpy soundfile")
         return None
+
+    # Too short for a RIFF header (an empty file cannot even be mapped)
+    if os.path.getsize(path) < 12:
+        return None
+
+    with open(path, "rb") as wav_file, \
+            mmap.mmap(wav_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+            return None
+
+        # Walk the RIFF chunks for "fmt " and "data"
+        fmt = None
+        pcm_offset = pcm_size = None
+        pos = 12
+        try:
+            while pos + 8 <= len(data):
+                chunk_id, chunk_size = struct.unpack_from("<4sI", data, pos)
+                body = pos + 8
+                if chunk_id == b"fmt " and chunk_size >= 16:
+                    fmt = struct.unpack_from("<HHIIHH", data, body)
+                    if fmt[0] == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                        # Real format tag is the first field of the SubFormat GUID
+                        fmt = (struct.unpack_from("<H", data, body + 24)[0],) + fmt[1:]
+                elif chunk_id == b"data":
+                    pcm_offset, pcm_size = body, min(chunk_size, len(data) - body)
+                    break
+                pos = body + chunk_size + (chunk_size & 1)
+        except (struct.error, ValueError):
+            # Truncated chunk: leave the file for the raw-encode fallback
+            return None
+        if fmt is None or pcm_offset is None:
+            return None
+
+        format_tag, channels, sample_rate, _, block_align, bits = fmt
+        dtype = _WAV_DTYPES.get((format_tag, bits))
+        if dtype is None or channels == 0 or block_align != channels * bits // 8:
+            return None
+        if channels == 1 and sample_rate == MODEL_SAMPLE_RATE and dtype == "<i2":
+            return None
+
+        frames = np.frombuffer(data, dtype=dtype, count=pcm_size // block_align * channels, offset=pcm_offset)
+        frames = frames.reshape(-1, channels)
+        # Downmix while converting to float32 in [-1, 1]
+        scale = 1.0 / channels
+        if format_tag == 1:
+            scale /= 2 ** (bits - 1)
+        mono = frames.sum(axis=1, dtype=np.float32)
+        del frames  # release the view on the mmap before it closes
+    mono *= scale
+
+    if sample_rate != MODEL_SAMPLE_RATE:
+        try:
+            from scipy.signal import resample_poly
+        except ImportError:
+            # Keep the original rate; the server resamples anything else
+            resample_poly = None
+        if resample_poly is not None:
+            g = math.gcd(sample_rate, MODEL_SAMPLE_RATE)
+            mono = resample_poly(mono, MODEL_SAMPLE_RATE // g, sample_rate // g)
+            sample_rate = MODEL_SAMPLE_RATE
+
+    return _pcm16_wav(mono, sample_rate)
+
+
+_sine_kernel = None
+
+
+def _get_sine_kernel():
+    """Return the Numba-compiled `_fill_sine`, or None if numba is not installed."""
+    global _sine_kernel
+    if _sine_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:
+            return None
+        _sine_kernel = njit(cache=True, fastmath=True)(_fill_sine)
+    return _sine_kernel
+
+
+def generate_test_tone(output_path: str | None = None, duration: float = 2.0, frequency: float = 440.0) -> str | None:
+    """
+    Generate a simple test tone audio file.
     
+    Args:
+        output_path: Path to save the test audio. Defaults to a name derived
+            from the tone parameters, which is reused if already generated
+        duration: Duration in seconds (0.1 to 300)
+        frequency: Frequency of the tone in Hz
+        
+    Returns:
+        str: Path to the generated file, or None if failed
+    """
     # Validate duration
     if duration < 0.1 or duration > 300:
         print(f"Duration must be between 0.1 and 300 seconds, got {duration}")
         return None
     
     sample_rate = 16000
-    t = np.linspace(0, duration, int(sample_rate * duration), False)
-    tone = 0.3 * np.sin(2 * np.pi * frequency * t)
+    num_samples = int(sample_rate * duration)
+    if output_path is None:
+        output_path = f".tone_{sample_rate}_{duration}_{frequency}.wav"
+        if os.path.exists(output_path) and os.path.getsize(output_path) == 44 + 2 * num_samples:
+            print(f"Using cached test tone: {output_path}")
+            return output_path
+    
+    try:
+        np = _np()
+    except ImportError:
+        print("Please install numpy: pip install numpy")
+        return None
+    
+    sine_kernel = _get_sine_kernel()
+    if sine_kernel is not None:
+        tone = np.empty(num_samples, dtype=np.float32)
+        sine_kernel(tone, 2 * np.pi * frequency / sample_rate, 0.3)
+    else:
+        # Build the phase directly in float32 and evaluate sin in place. The sample
+        # index is first reduced modulo the tone period in float64, so the
+        # phase stays within one cycle and keeps full float32 precision at any length
+        period = sample_rate / frequency
+        tone = np.fmod(np.arange(num_samples, dtype=np.float64), period).astype(np.float32)
+        np.multiply(tone, np.float32(2 * np.pi * frequency / sample_rate), out=tone)
+        np.sin(tone, out=tone)
+        np.multiply(tone, np.float32(0.3), out=tone)
     
     try:
-        sf.write(output_path, tone.astype(np.float32), sample_rate)
+        _write_wav_pcm16(output_path, tone, sample_rate)
         print(f"Test tone saved to: {output_path}")
         return output_path
     except Exception as e:
@@ -127,48 +505,88 @@ def generate_test_tone(output_path: str = "test_tone.wav", duration: float = 2.0
         return None
 
 
+def _cached_base64(file_path: str) -> bytes | bytearray:
+    """
+    Base64-encode a file, caching the result next to it as `<file>.b64`.
+    
+    The cache is reused while it is newer than the file itself.
+    """
+    cache_path = file_path + ".b64"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
+    base64_audio = audio_to_base64(file_path)
+    with open(cache_path, "wb") as f:
+        f.write(base64_audio)
+    return base64_audio
+
+
 def main():
     """Main function to demonstrate usage."""
     print("=" * 60)
     print("Deepfake Audio Detection - Test Utility")
     print("=" * 60)
     
-    if len(sys.argv) < 2:
+    # --no-cache may appear anywhere on the command line
+    args = sys.argv[1:]
+    use_cache = "--no-cache" not in args
+    args = [arg for arg in args if arg != "--no-cache"]
+    
+    if not args:
         print("\nUsage:")
         print("  python test_audio.py <audio_file.wav>    - Test an audio file")
+        print("  python test_audio.py --no-cache <file>   - Test an audio file, ignoring stored results")
         print("  python test_audio.py --generate          - Generate test tone")
         print("  python test_audio.py --convert <file>    - Convert file to Base64")
+        print("  python test_audio.py --batch <dir>       - Test every .wav file in a directory")
         print("\nExample:")
         print("  python test_audio.py my_voice.wav")
         print("  python test_audio.py --generate")
         return
     
-    command = sys.argv[1]
+    command = args[0]
     
     if command == "--generate":
         # Generate test tone
         test_file = generate_test_tone()
         if test_file:
-            base64_audio = audio_to_base64(test_file)
-            print(f"\nBase64 (first 100 chars): {base64_audio[:100]}...")
+            base64_audio = _cached_base64(test_file)
+            print(f"\nBase64 (first 100 chars): {base64_audio[:100].decode('ascii')}...")
             print("\nTesting API with generated tone...")
             test_api(base64_audio)
             
+    elif command == "--batch":
+        if len(args) < 2:
+            print("Please provide a directory: python test_audio.py --batch <dir>")
+            return
+        directory = args[1]
+        if os.path.isdir(directory):
+            detect_batch(directory)
+        else:
+            print(f"Directory not found: {directory}")
+            
     elif command == "--convert":
-        if len(sys.argv) < 3:
+        if len(args) < 2:
             print("Please provide a file path: python test_audio.py --convert <file.wav>")
             return
-        file_path = sys.argv[2]
+        file_path = args[1]
         if os.path.exists(file_path):
-            base64_audio = audio_to_base64(file_path)
+            base64_audio = audio_to_base64(file_path, normalize=False)
             print(f"\nBase64 encoded audio ({len(base64_audio)} characters):")
             print("-" * 60)
-            print(base64_audio)
+            if len(base64_audio) < MAX_PRINTED_BASE64:
+                # Small payloads are shown in full, written as bytes without a str round trip
+                sys.stdout.flush()
+                sys.stdout.buffer.write(base64_audio + b"\n")
+                sys.stdout.buffer.flush()
+            else:
+                # Only a short preview is decoded for display; the full payload goes to disk
+                print(f"{base64_audio[:100].decode('ascii')}...")
             print("-" * 60)
             
             # Save to file
             output_file = file_path.rsplit(".", 1)[0] + "_base64.txt"
-            with open(output_file, "w") as f:
+            with open(output_file, "wb") as f:
                 f.write(base64_audio)
             print(f"\nBase64 saved to: {output_file}")
         else:
@@ -179,9 +597,7 @@ def main():
         file_path = command
         if os.path.exists(file_path):
             print(f"\nConverting audio file: {file_path}")
-            base64_audio = audio_to_base64(file_path)
-            print(f"Base64 length: {len(base64_audio)} characters")
-            test_api(base64_audio)
+            detect_file(file_path, use_cache=use_cache)
         else:
             print(f"File not found: {file_path}")
 